@@ -1,33 +1,69 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import json
+import logging
 import secrets
 import time
-from typing import Dict, Any, List, Optional
-
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Body
-from fastapi.responses import HTMLResponse
+from collections import deque
+from contextlib import asynccontextmanager
+from itertools import islice
+from typing import Annotated, Dict, Any, List, Optional
+
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Body, Depends, HTTPException
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi.routing import APIRoute
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from pydantic import BaseModel, Field, StringConstraints
 import uvicorn
 import os
 
+log = logging.getLogger("bingocoin")
+
+try:
+    import ormsgpack
+except ImportError:  # fallback: JSON
+    ormsgpack = None
+
+try:
+    import orjson
+except ImportError:  # fallback: stdlib json
+    orjson = None
+
 # ==========================
 # CONFIG
 # ==========================
 APP_TITLE = "BingoCoin"
 CASHIER_PIN = "4321"   # Cambialo
 PORT = 9090
+MAX_AMOUNT = 10**12          # importo massimo per operazione: saldi e montepremi restano ben dentro int64
+LOG_MAX = 300
+LEDGER_MAX = 500             # movimenti conservati per utente (ne vengono mostrati HISTORY_MAX)
+HISTORY_MAX = 250            # movimenti inviati al giocatore
+BROADCAST_DELAY = 0.02       # finestra (s) in cui più modifiche producono un solo broadcast
+BROADCAST_BATCH = 50         # client serviti prima di cedere il controllo all'event loop
 
 # ==========================
 # IN-MEMORY STATE (NO DB)
 # ==========================
 GAME: Dict[str, Any] = {
-    "players": {},               # user_id -> {name, role, saldo}
-    "ledger": {},                # user_id -> list of {delta, note, ts}
-    "prizes": [],                # list of {name, amount, winner_id, paid, ts}
+    "players": {},               # user_id -> {name, _name_lc, role, saldo}
+    "player_ids": set(),         # user_id con ruolo giocatore
+    "ledger": {},                # user_id -> deque of {delta, note, ts} (più recenti prima)
+    "prizes": {},                # prize_id -> {id, name, amount, winner_id, paid, ts}
+    "prizes_unpaid": {},         # prize_id -> premio non ancora assegnato (ordine di creazione)
+    "prizes_paid": [],           # premi assegnati, in ordine di pagamento
+    "prize_seq": 0,              # prossimo id premio
     "pot": 0,                    # montepremi
-    "log": [],
-    "cashier_rejoin_token": None # segreto per rientro cassiere
+    "prizes_unpaid_total": 0,    # somma importi premi non pagati
+    "prizes_paid_total": 0,      # somma importi premi pagati
+    "log": deque(maxlen=LOG_MAX),
+    "cashier_rejoin_token": None, # segreto per rientro cassiere
+    "cashier_id": None,          # user_id del cassiere attivo
+    "version": 0,                # incrementato a ogni modifica dello stato
 }
 
 # ==========================
@@ -36,114 +72,128 @@ GAME: Dict[str, Any] = {
 def now_ts() -> int:
     return int(time.time())
 
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    _json_loads = json.loads
+
+# Snapshot WS: msgpack se disponibile, altrimenti JSON (il client distingue dal primo byte)
+_encode = ormsgpack.packb if ormsgpack is not None else _json_dumps
+
+def set_pot(value: int) -> int:
+    # unico punto di scrittura del montepremi: lo mantiene int, le letture non convertono
+    GAME["pot"] = int(value)
+    return GAME["pot"]
+
 def add_log(msg: str) -> None:
-    GAME["log"].insert(0, {"ts": now_ts(), "msg": msg})
-    GAME["log"] = GAME["log"][:300]
+    GAME["log"].appendleft({"ts": now_ts(), "msg": msg})
 
-def ensure_ledger(uid: str) -> None:
-    if uid not in GAME["ledger"]:
-        GAME["ledger"][uid] = []
+def ensure_ledger(uid: str) -> deque:
+    ledger = GAME["ledger"].get(uid)
+    if ledger is None:
+        ledger = GAME["ledger"][uid] = deque(maxlen=LEDGER_MAX)
+    return ledger
 
 def add_ledger_delta(uid: str, delta: int, note: str) -> None:
-    ensure_ledger(uid)
-    GAME["ledger"][uid].insert(0, {"delta": int(delta), "note": note, "ts": now_ts()})
-    GAME["ledger"][uid] = GAME["ledger"][uid][:1500]
+    ensure_ledger(uid).appendleft({"delta": int(delta), "note": note, "ts": now_ts()})
 
 def get_cashier_id() -> Optional[str]:
-    for uid, p in GAME["players"].items():
-        if p.get("role") == "cassiere":
-            return uid
-    return None
+    return GAME["cashier_id"]
 
 def require_cashier(req: Request) -> str:
     uid = req.headers.get("X-User")
     if not uid or uid not in GAME["players"]:
-        raise PermissionError("Non autorizzato")
+        raise HTTPException(status_code=403, detail="Non autorizzato")
     if GAME["players"][uid]["role"] != "cassiere":
-        raise PermissionError("Solo cassiere")
+        raise HTTPException(status_code=403, detail="Solo cassiere")
     return uid
 
 def require_player(req: Request) -> str:
     uid = req.headers.get("X-User")
     if not uid or uid not in GAME["players"]:
-        raise PermissionError("Non autorizzato")
+        raise HTTPException(status_code=403, detail="Non autorizzato")
     if GAME["players"][uid]["role"] != "giocatore":
-        raise PermissionError("Solo giocatore")
+        raise HTTPException(status_code=403, detail="Solo giocatore")
     return uid
 
-def total_prizes_defined_unpaid() -> int:
-    return sum(int(p.get("amount", 0)) for p in GAME["prizes"] if not p.get("paid", False))
-
-def total_prizes_paid() -> int:
-    return sum(int(p.get("amount", 0)) for p in GAME["prizes"] if p.get("paid"))
-
 # ==========================
 # PRIVACY / STATE EXPORT
 # ==========================
-def _players_public_for(viewer_id: Optional[str]) -> List[Dict[str, Any]]:
-    viewer = GAME["players"].get(viewer_id) if viewer_id else None
-    viewer_role = viewer["role"] if viewer else None
-
-    out: List[Dict[str, Any]] = []
-    for uid, pdata in GAME["players"].items():
-        item = {"id": uid, "name": pdata["name"], "role": pdata["role"]}
-        if viewer_role == "cassiere":
-            item["saldo"] = int(pdata.get("saldo", 0))
-        else:
-            item["saldo"] = int(pdata.get("saldo", 0)) if (viewer_id and uid == viewer_id) else None
-        out.append(item)
-
-    out.sort(key=lambda x: x["name"].lower())
-    return out
+def _players_base() -> List[Dict[str, Any]]:
+    # id/nome/ruolo ordinati per nome: identici per ogni viewer, si calcolano una volta per broadcast
+    ordered = sorted(GAME["players"].items(), key=lambda kv: kv[1]["_name_lc"])
+    return [{"id": uid, "name": pdata["name"], "role": pdata["role"]} for uid, pdata in ordered]
+
+def _players_public_for(viewer_id: Optional[str], base: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    players = GAME["players"]
+    viewer = players.get(viewer_id) if viewer_id else None
+    if base is None:
+        base = _players_base()
+
+    # i saldi sono sempre interi: scritti solo con valori int
+    if viewer is not None and viewer["role"] == "cassiere":
+        return [{**e, "saldo": players[e["id"]]["saldo"]} for e in base]
+    own_saldo = viewer["saldo"] if viewer is not None else None
+    return [{**e, "saldo": own_saldo if e["id"] == viewer_id else None} for e in base]
 
 def _my_history_public_for(viewer_id: Optional[str]) -> List[Dict[str, Any]]:
-    if not viewer_id or viewer_id not in GAME["players"]:
-        return []
-    if GAME["players"][viewer_id]["role"] != "giocatore":
+    viewer = GAME["players"].get(viewer_id) if viewer_id else None
+    if viewer is None or viewer["role"] != "giocatore":
         return []
-    ensure_ledger(viewer_id)
-    return [{"delta": int(x["delta"]), "note": x["note"], "ts": int(x["ts"])} for x in GAME["ledger"][viewer_id]][:250]
+    # delta e ts sono già int (add_ledger_delta / now_ts)
+    return [{"delta": x["delta"], "note": x["note"], "ts": x["ts"]} for x in islice(ensure_ledger(viewer_id), HISTORY_MAX)]
 
-def public_state_for(viewer_id: Optional[str]) -> Dict[str, Any]:
-    viewer = GAME["players"].get(viewer_id) if viewer_id else None
+def public_state_for(viewer_id: Optional[str], players_base: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    game = GAME
+    viewer = game["players"].get(viewer_id) if viewer_id else None
     role = viewer["role"] if viewer else None
+    is_cashier = role == "cassiere"
 
     # Premi:
     # - cassiere: tutti
     # - giocatore: solo non assegnati (paid=False)
-    if role == "cassiere":
-        prizes_out = GAME["prizes"]
+    if is_cashier:
+        prizes_out = game["prizes_paid"] + list(game["prizes_unpaid"].values())
     elif role == "giocatore":
-        prizes_out = [p for p in GAME["prizes"] if not p.get("paid", False)]
+        prizes_out = list(game["prizes_unpaid"].values())
     else:
         prizes_out = []
 
-    pot = int(GAME["pot"])
-    unpaid = total_prizes_defined_unpaid()
-    pot_remaining = pot - unpaid
-    if pot_remaining < 0:
-        pot_remaining = 0
-
-    pot_block = (
-        {
+    pot = game["pot"]
+    if is_cashier:
+        unpaid = game["prizes_unpaid_total"]
+        pot_block = {
             "pot": pot,
             "prizes_defined_total": unpaid,
-            "prizes_paid_total": total_prizes_paid(),
-            "pot_remaining": int(pot_remaining),
+            "prizes_paid_total": game["prizes_paid_total"],
+            "pot_remaining": max(pot - unpaid, 0),
         }
-        if role == "cassiere"
-        else {"pot": pot}
-    )
+    else:
+        pot_block = {"pot": pot}
 
     return {
         "title": APP_TITLE,
-        "players": _players_public_for(viewer_id),
+        "players": _players_public_for(viewer_id, players_base),
         "my_history": _my_history_public_for(viewer_id),
         "prizes": prizes_out,
         "pot": pot_block,
-        "log": GAME["log"],
+        # log solo al cassiere: è l'unico che lo mostra e contiene importi di altri giocatori
+        "log": list(game["log"]) if is_cashier else [],
     }
 
+def _viewer_key(viewer_id: Optional[str]) -> Optional[str]:
+    # Chiave di cache dello snapshot: i cassieri vedono tutti lo stesso stato,
+    # ogni giocatore ha il proprio (saldo + movimenti), gli anonimi uno solo.
+    viewer = GAME["players"].get(viewer_id) if viewer_id else None
+    if viewer is None:
+        return None
+    if viewer["role"] == "cassiere":
+        return "cassiere"
+    return viewer_id
+
 # ==========================
 # WS MANAGER
 # ==========================
@@ -151,40 +201,146 @@ class WSManager:
     def __init__(self) -> None:
         self.clients: List[WebSocket] = []
         self.ws_user: Dict[WebSocket, Optional[str]] = {}
+        self.pending: Dict[WebSocket, bytes] = {}             # ultimo snapshot non ancora inviato
+        self.wakeup: Dict[WebSocket, asyncio.Event] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
+        self.ws_version: Dict[WebSocket, int] = {}            # versione dell'ultimo snapshot accodato
+        self._broadcast_wakeup = asyncio.Event()
+        # snapshot codificati per chiave viewer, validi finché GAME["version"] non cambia
+        self._cache: Dict[Optional[str], bytes] = {}
+        self._cache_version = -1
+        self._cache_base: Optional[List[Dict[str, Any]]] = None
 
     async def connect(self, ws: WebSocket) -> None:
         await ws.accept()
         self.clients.append(ws)
         self.ws_user[ws] = None
+        self.wakeup[ws] = asyncio.Event()
+        self.writers[ws] = asyncio.create_task(self._writer(ws))
 
     def disconnect(self, ws: WebSocket) -> None:
         if ws in self.clients:
             self.clients.remove(ws)
         self.ws_user.pop(ws, None)
+        self.pending.pop(ws, None)
+        self.wakeup.pop(ws, None)
+        self.ws_version.pop(ws, None)
+        task = self.writers.pop(ws, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
 
     def set_user(self, ws: WebSocket, user_id: Optional[str]) -> None:
         self.ws_user[ws] = user_id if (user_id in GAME["players"]) else None
 
-    async def send_state(self, ws: WebSocket) -> None:
-        uid = self.ws_user.get(ws)
-        await ws.send_text(json.dumps(public_state_for(uid)))
+    def _push(self, ws: WebSocket, payload: bytes) -> None:
+        # slot singolo: uno snapshot più recente sostituisce quello non ancora inviato
+        event = self.wakeup.get(ws)
+        if event is None:  # disconnesso nel frattempo
+            return
+        self.pending[ws] = payload
+        event.set()
+
+    async def _writer(self, ws: WebSocket) -> None:
+        event = self.wakeup[ws]
+        try:
+            while True:
+                await event.wait()
+                event.clear()
+                payload = self.pending.pop(ws, None)
+                if payload is not None:
+                    await ws.send_bytes(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(ws)
 
-    async def broadcast(self) -> None:
-        dead: List[WebSocket] = []
-        for ws in self.clients:
+    def _payload_for(self, uid: Optional[str]) -> bytes:
+        version = GAME["version"]
+        if self._cache_version != version:
+            self._cache.clear()
+            self._cache_version = version
+            self._cache_base = None
+        key = _viewer_key(uid)
+        payload = self._cache.get(key)
+        if payload is None:
+            if self._cache_base is None:
+                self._cache_base = _players_base()
+            payload = self._cache[key] = _encode(public_state_for(uid, self._cache_base))
+        return payload
+
+    def send_state(self, ws: WebSocket) -> None:
+        self.ws_version[ws] = GAME["version"]
+        self._push(ws, self._payload_for(self.ws_user.get(ws)))
+
+    def schedule_broadcast(self) -> None:
+        self._broadcast_wakeup.set()
+
+    async def run(self) -> None:
+        # unico task di broadcast: le modifiche arrivate entro BROADCAST_DELAY confluiscono in uno
+        while True:
+            await self._broadcast_wakeup.wait()
+            await asyncio.sleep(BROADCAST_DELAY)
+            self._broadcast_wakeup.clear()
             try:
-                await self.send_state(ws)
+                await self.broadcast()
             except Exception:
-                dead.append(ws)
-        for ws in dead:
-            self.disconnect(ws)
+                # un broadcast fallito non deve fermare il task: i successivi devono partire
+                log.exception("broadcast fallito")
+
+    async def broadcast(self) -> None:
+        if not self.clients:
+            return
+        version = GAME["version"]
+        for i, ws in enumerate(list(self.clients), 1):
+            if i % BROADCAST_BATCH == 0:
+                await asyncio.sleep(0)
+                # stato cambiato durante la pausa: i restanti ricevono subito la versione nuova,
+                # i precedenti la prendono dal prossimo broadcast (già segnalato)
+                version = GAME["version"]
+            if ws not in self.wakeup:
+                # disconnesso durante la pausa: non ri-registrare la versione di un socket morto
+                continue
+            if self.ws_version.get(ws) == version:
+                continue
+            self.ws_version[ws] = version
+            self._push(ws, self._payload_for(self.ws_user.get(ws)))
 
 ws_manager = WSManager()
 
 # ==========================
 # FASTAPI
 # ==========================
-app = FastAPI(title=APP_TITLE)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(ws_manager.run())
+    yield
+    task.cancel()
+
+class FastJSONRequest(Request):
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = _json_loads(await self.body())
+        return self._json
+
+class FastJSONRoute(APIRoute):
+    # i body JSON delle POST vengono letti con orjson (se disponibile)
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            return await handler(FastJSONRequest(request.scope, request.receive))
+
+        return route_handler
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return _json_dumps(content)
+
+app = FastAPI(title=APP_TITLE, lifespan=lifespan, default_response_class=FastJSONResponse)
+app.router.route_class = FastJSONRoute
+
+# risposta di successo delle POST, codificata una volta sola (Response è senza stato: riusabile)
+OK_RESPONSE = Response(content=b'{"ok":true}', media_type="application/json")
 
 # ==========================
 # HTML UI
@@ -368,8 +524,59 @@ HTML = """<!doctype html>
 let ws = null;
 let snapshot = null;
 let me = { id: null, name: null, role: null };
+const utf8 = new TextDecoder();
 const el = (id) => document.getElementById(id);
 
+// Decoder msgpack minimale (solo i tipi prodotti dal server)
+function unpack(buf){
+  const view = new DataView(buf);
+  const bytes = new Uint8Array(buf);
+  let pos = 0;
+  const str = (n) => { const s = utf8.decode(bytes.subarray(pos, pos + n)); pos += n; return s; };
+  const arr = (n) => { const a = new Array(n); for(let i = 0; i < n; i++) a[i] = read(); return a; };
+  const map = (n) => { const o = {}; for(let i = 0; i < n; i++){ const k = read(); o[k] = read(); } return o; };
+  function read(){
+    const b = bytes[pos++];
+    if(b <= 0x7f) return b;
+    if(b <= 0x8f) return map(b & 0x0f);
+    if(b <= 0x9f) return arr(b & 0x0f);
+    if(b <= 0xbf) return str(b & 0x1f);
+    if(b >= 0xe0) return b - 0x100;
+    let v;
+    switch(b){
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xca: v = view.getFloat32(pos); pos += 4; return v;
+      case 0xcb: v = view.getFloat64(pos); pos += 8; return v;
+      case 0xcc: return bytes[pos++];
+      case 0xcd: v = view.getUint16(pos); pos += 2; return v;
+      case 0xce: v = view.getUint32(pos); pos += 4; return v;
+      case 0xcf: v = Number(view.getBigUint64(pos)); pos += 8; return v;
+      case 0xd0: return view.getInt8(pos++);
+      case 0xd1: v = view.getInt16(pos); pos += 2; return v;
+      case 0xd2: v = view.getInt32(pos); pos += 4; return v;
+      case 0xd3: v = Number(view.getBigInt64(pos)); pos += 8; return v;
+      case 0xd9: return str(bytes[pos++]);
+      case 0xda: v = view.getUint16(pos); pos += 2; return str(v);
+      case 0xdb: v = view.getUint32(pos); pos += 4; return str(v);
+      case 0xdc: v = view.getUint16(pos); pos += 2; return arr(v);
+      case 0xdd: v = view.getUint32(pos); pos += 4; return arr(v);
+      case 0xde: v = view.getUint16(pos); pos += 2; return map(v);
+      case 0xdf: v = view.getUint32(pos); pos += 4; return map(v);
+    }
+    throw new Error("msgpack: tipo non supportato 0x" + b.toString(16));
+  }
+  return read();
+}
+
+function decodeFrame(data){
+  if(typeof data === "string") return JSON.parse(data);
+  // 0x7b = "{": il server sta usando il fallback JSON
+  if(new Uint8Array(data, 0, 1)[0] === 0x7b) return JSON.parse(utf8.decode(data));
+  return unpack(data);
+}
+
 function fmtBE(n){
   if(n === null || typeof n === "undefined") return "—";
   return `${n} b€`;
@@ -418,6 +625,7 @@ function wsUrl(){
 
 function connectWS(){
   ws = new WebSocket(wsUrl());
+  ws.binaryType = "arraybuffer";
   ws.onopen = () => {
     el("status").textContent = "Connesso";
     if(me.id){
@@ -429,7 +637,7 @@ function connectWS(){
     setTimeout(connectWS, 1200);
   };
   ws.onmessage = (ev) => {
-    snapshot = JSON.parse(ev.data);
+    snapshot = decodeFrame(ev.data);
     render();
   };
 }
@@ -582,7 +790,7 @@ function render(){
   if(prizes.length === 0){
     assign.innerHTML = `<div class="pill"><div>Nessun premio definito.</div></div>`;
   } else {
-    prizes.forEach((pr, idx) => {
+    prizes.forEach(pr => {
       const paid = !!pr.paid;
       const div = document.createElement("div");
       div.className = "pill";
@@ -616,7 +824,7 @@ function render(){
         s.addEventListener("change", async (e) => {
           const winner_id = e.target.value || null;
           if(!winner_id) return;
-          await postAuthed("/cashier/assign_prize", {index: idx, winner_id});
+          await postAuthed("/cashier/assign_prize", {id: pr.id, winner_id});
         });
       }
 
@@ -697,29 +905,86 @@ setInterval(() => {
 </html>
 """
 
+HTML_BYTES = HTML.encode("utf-8")
+HTML_ETAG = '"' + hashlib.sha1(HTML_BYTES).hexdigest() + '"'
+
 @app.get("/", response_class=HTMLResponse)
-async def index():
-    return HTMLResponse(HTML)
+async def index(req: Request):
+    headers = {"ETag": HTML_ETAG, "Cache-Control": "no-cache"}
+    if req.headers.get("if-none-match") == HTML_ETAG:
+        return Response(status_code=304, headers=headers)
+    return Response(HTML_BYTES, media_type="text/html", headers=headers)
 
 @app.websocket("/ws")
 async def ws_endpoint(ws: WebSocket):
     await ws_manager.connect(ws)
-    await ws_manager.send_state(ws)
     try:
+        ws_manager.send_state(ws)
         while True:
             msg = await ws.receive_text()
+            # keepalive "ping" e messaggi non-JSON: niente parse
+            if msg == "ping" or not msg.startswith("{"):
+                continue
             try:
-                data = json.loads(msg)
-                if isinstance(data, dict) and "auth" in data:
-                    ws_manager.set_user(ws, str(data.get("auth", "")).strip())
-                    await ws_manager.send_state(ws)
-            except Exception:
-                pass
+                data = _json_loads(msg)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and "auth" in data:
+                ws_manager.set_user(ws, str(data.get("auth", "")).strip())
+                ws_manager.send_state(ws)
     except WebSocketDisconnect:
         ws_manager.disconnect(ws)
     except Exception:
         ws_manager.disconnect(ws)
 
+# ==========================
+# REQUEST BODIES
+# ==========================
+NonEmptyStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+# orjson/ormsgpack gestiscono solo interi a 64 bit: gli importi vanno limitati
+Amount = Annotated[int, Field(gt=0, le=MAX_AMOUNT)]
+
+class PlayIn(BaseModel):
+    amount: Amount
+
+class CreditIn(BaseModel):
+    player_id: NonEmptyStr
+    amount: Amount
+
+class PrizeIn(BaseModel):
+    name: NonEmptyStr
+    amount: Amount
+
+class AssignPrizeIn(BaseModel):
+    id: int
+    winner_id: NonEmptyStr
+
+# messaggi per campo, come li restituivano i controlli manuali
+_FIELD_ERRORS = {
+    "amount": "Importo non valido",
+    "player_id": "Giocatore non valido",
+    "name": "Nome premio mancante",
+    "id": "Id premio non valido",
+    "winner_id": "Vincitore non valido",
+}
+
+@app.exception_handler(StarletteHTTPException)
+async def http_error(req: Request, exc: StarletteHTTPException):
+    # testo semplice, come gli altri errori mostrati dalla UI con alert()
+    return HTMLResponse(str(exc.detail), status_code=exc.status_code, headers=exc.headers)
+
+@app.exception_handler(RequestValidationError)
+async def validation_error(req: Request, exc: RequestValidationError):
+    err = exc.errors()[0]
+    field = err["loc"][-1] if err["loc"] else None
+    if field == "amount" and err["type"] == "greater_than":
+        msg = "Importo deve essere > 0"
+    elif field == "amount" and err["type"] == "less_than_equal":
+        msg = f"Importo troppo alto (max {MAX_AMOUNT})"
+    else:
+        msg = _FIELD_ERRORS.get(field, "Richiesta non valida")
+    return HTMLResponse(msg, status_code=400)
+
 # ==========================
 # JOIN
 # ==========================
@@ -749,216 +1014,205 @@ async def join(data: Dict[str, Any] = Body(...)):
                 return HTMLResponse("Cassiere già attivo: token di rientro mancante o non valido", status_code=403)
 
             GAME["players"][existing]["name"] = name
+            GAME["players"][existing]["_name_lc"] = name.lower()
             add_log(f"Cassiere rientrato: {name}")
-            await ws_manager.broadcast()
+            GAME["version"] += 1
+            ws_manager.schedule_broadcast()
             return {"id": existing, "name": name, "role": "cassiere", "rejoin_token": server_token}
 
         # Caso B: nessun cassiere -> crea cassiere nuovo e genera token rientro
         uid = secrets.token_hex(8)
-        GAME["players"][uid] = {"name": name, "role": "cassiere", "saldo": 0}
+        GAME["players"][uid] = {"name": name, "_name_lc": name.lower(), "role": "cassiere", "saldo": 0}
+        GAME["cashier_id"] = uid
         ensure_ledger(uid)
 
         token = secrets.token_urlsafe(18)
         GAME["cashier_rejoin_token"] = token
 
         add_log(f"{name} è entrato (cassiere)")
-        await ws_manager.broadcast()
+        GAME["version"] += 1
+        ws_manager.schedule_broadcast()
         return {"id": uid, "name": name, "role": "cassiere", "rejoin_token": token}
 
-    # giocatore
+    # giocatore: id casuale, così un id rimasto nel browser dopo un riavvio non coincide con un nuovo giocatore
     uid = secrets.token_hex(8)
-    GAME["players"][uid] = {"name": name, "role": "giocatore", "saldo": 0}
+    GAME["players"][uid] = {"name": name, "_name_lc": name.lower(), "role": "giocatore", "saldo": 0}
+    GAME["player_ids"].add(uid)
     ensure_ledger(uid)
     add_log(f"{name} è entrato (giocatore)")
-    await ws_manager.broadcast()
+    GAME["version"] += 1
+    ws_manager.schedule_broadcast()
     return {"id": uid, "name": name, "role": "giocatore"}
 
 # ==========================
 # PLAYER
 # ==========================
 @app.post("/player/play")
-async def player_play(req: Request, data: Dict[str, Any] = Body(...)):
-    try:
-        player_id = require_player(req)
-    except PermissionError as e:
-        return HTMLResponse(str(e), status_code=403)
+async def player_play(data: PlayIn, player_id: str = Depends(require_player)):
+    amount = data.amount
 
-    try:
-        amount = int(data.get("amount"))
-    except Exception:
-        return HTMLResponse("Importo non valido", status_code=400)
-    if amount <= 0:
-        return HTMLResponse("Importo deve essere > 0", status_code=400)
-
-    saldo = int(GAME["players"][player_id].get("saldo", 0))
+    player = GAME["players"][player_id]
+    saldo = player["saldo"]
     if amount > saldo:
         return HTMLResponse("Importo superiore al saldo disponibile", status_code=400)
 
-    GAME["players"][player_id]["saldo"] = saldo - amount
+    player["saldo"] = saldo - amount
     add_ledger_delta(player_id, -amount, "Gioca")
 
-    GAME["pot"] = int(GAME["pot"]) + amount
-    add_log(f"Montepremi +{amount} (da {GAME['players'][player_id]['name']})")
-    await ws_manager.broadcast()
-    return {"ok": True, "pot": int(GAME["pot"])}
+    pot = set_pot(GAME["pot"] + amount)
+    add_log(f"Montepremi +{amount} (da {player['name']})")
+    GAME["version"] += 1
+    ws_manager.schedule_broadcast()
+    return {"ok": True, "pot": pot}
 
 # ==========================
 # CASHIER
 # ==========================
 @app.post("/cashier/credit")
-async def cashier_credit(req: Request, data: Dict[str, Any] = Body(...)):
-    try:
-        cashier_id = require_cashier(req)
-    except PermissionError as e:
-        return HTMLResponse(str(e), status_code=403)
-
-    player_id = str(data.get("player_id", "")).strip()
-    if not player_id or player_id not in GAME["players"]:
+async def cashier_credit(data: CreditIn, cashier_id: str = Depends(require_cashier)):
+    players = GAME["players"]
+    player_id = data.player_id
+    if player_id not in GAME["player_ids"]:
         return HTMLResponse("Giocatore non valido", status_code=400)
-    if GAME["players"][player_id]["role"] != "giocatore":
-        return HTMLResponse("Seleziona un giocatore", status_code=400)
+    player = players[player_id]
 
-    try:
-        amount = int(data.get("amount"))
-    except Exception:
-        return HTMLResponse("Importo non valido", status_code=400)
-    if amount <= 0:
-        return HTMLResponse("Importo deve essere > 0", status_code=400)
+    amount = data.amount
+    pname = player["name"]
 
-    GAME["players"][player_id]["saldo"] += amount
+    player["saldo"] += amount
     add_ledger_delta(player_id, amount, "Accredito")
 
-    GAME["players"][cashier_id]["saldo"] -= amount
-    add_ledger_delta(cashier_id, -amount, f"Accredito a {GAME['players'][player_id]['name']}")
-
-    add_log(f"Accredito: {GAME['players'][player_id]['name']} +{amount} · Cassiere -{amount}")
-    await ws_manager.broadcast()
-    return {"ok": True}
+    players[cashier_id]["saldo"] -= amount
+    add_ledger_delta(cashier_id, -amount, f"Accredito a {pname}")
 
-@app.post("/cashier/add_prize")
-async def cashier_add_prize(req: Request, data: Dict[str, Any] = Body(...)):
-    try:
-        require_cashier(req)
-    except PermissionError as e:
-        return HTMLResponse(str(e), status_code=403)
+    add_log(f"Accredito: {pname} +{amount} · Cassiere -{amount}")
+    GAME["version"] += 1
+    ws_manager.schedule_broadcast()
+    return OK_RESPONSE
 
-    name = str(data.get("name", "")).strip()
-    if not name:
-        return HTMLResponse("Nome premio mancante", status_code=400)
-
-    try:
-        amount = int(data.get("amount"))
-    except Exception:
-        return HTMLResponse("Importo non valido", status_code=400)
-    if amount <= 0:
-        return HTMLResponse("Importo deve essere > 0", status_code=400)
+@app.post("/cashier/add_prize", dependencies=[Depends(require_cashier)])
+async def cashier_add_prize(data: PrizeIn):
+    name = data.name
+    amount = data.amount
 
-    defined_unpaid = total_prizes_defined_unpaid()
-    pot = int(GAME["pot"])
+    defined_unpaid = GAME["prizes_unpaid_total"]
+    pot = GAME["pot"]
     if defined_unpaid + amount > pot:
         return HTMLResponse(
             f"Premi (non pagati) eccedono il montepremi: {defined_unpaid}+{amount} > {pot}",
             status_code=400,
         )
 
-    GAME["prizes"].append({
+    prize_id = GAME["prize_seq"]
+    GAME["prize_seq"] = prize_id + 1
+    prize = {
+        "id": prize_id,
         "name": name,
         "amount": amount,
         "winner_id": None,
         "paid": False,
         "ts": now_ts(),
-    })
+    }
+    GAME["prizes"][prize_id] = prize
+    GAME["prizes_unpaid"][prize_id] = prize
+    GAME["prizes_unpaid_total"] += amount
     add_log(f"Premio definito: {name} = {amount}")
-    await ws_manager.broadcast()
-    return {"ok": True}
-
-@app.post("/cashier/assign_prize")
-async def cashier_assign_prize(req: Request, data: Dict[str, Any] = Body(...)):
-    try:
-        require_cashier(req)
-    except PermissionError as e:
-        return HTMLResponse(str(e), status_code=403)
-
-    try:
-        idx = int(data.get("index"))
-    except Exception:
-        return HTMLResponse("Indice premio non valido", status_code=400)
-    if idx < 0 or idx >= len(GAME["prizes"]):
+    GAME["version"] += 1
+    ws_manager.schedule_broadcast()
+    return OK_RESPONSE
+
+@app.post("/cashier/assign_prize", dependencies=[Depends(require_cashier)])
+async def cashier_assign_prize(data: AssignPrizeIn):
+    prize_id = data.id
+    prize = GAME["prizes"].get(prize_id)
+    if prize is None:
         return HTMLResponse("Premio non trovato", status_code=404)
-
-    prize = GAME["prizes"][idx]
-    if prize.get("paid", False):
+    if prize["paid"]:
         return HTMLResponse("Premio già pagato", status_code=400)
 
-    winner_id = str(data.get("winner_id", "")).strip()
-    if not winner_id or winner_id not in GAME["players"]:
-        return HTMLResponse("Vincitore non valido", status_code=400)
-    if GAME["players"][winner_id]["role"] != "giocatore":
-        return HTMLResponse("Il vincitore deve essere un giocatore", status_code=400)
+    winner_id = data.winner_id
+    if winner_id not in GAME["player_ids"]:
+        return HTMLResponse("Vincitore non valido (deve essere un giocatore)", status_code=400)
+    winner = GAME["players"][winner_id]
 
-    amount = int(prize["amount"])
-    pname = str(prize["name"])
+    amount = prize["amount"]
+    pname = prize["name"]
 
-    if int(GAME["pot"]) < amount:
+    if GAME["pot"] < amount:
         return HTMLResponse("Montepremi insufficiente per pagare questo premio", status_code=400)
 
-    GAME["players"][winner_id]["saldo"] += amount
+    winner["saldo"] += amount
     add_ledger_delta(winner_id, amount, f"Premio: {pname}")
 
-    GAME["pot"] = int(GAME["pot"]) - amount
+    set_pot(GAME["pot"] - amount)
 
     prize["winner_id"] = winner_id
     prize["paid"] = True
+    del GAME["prizes_unpaid"][prize_id]
+    GAME["prizes_paid"].append(prize)
+    GAME["prizes_unpaid_total"] -= amount
+    GAME["prizes_paid_total"] += amount
 
-    add_log(f"Premio assegnato: {pname} -> {GAME['players'][winner_id]['name']} ({amount})")
-    await ws_manager.broadcast()
-    return {"ok": True}
+    add_log(f"Premio assegnato: {pname} -> {winner['name']} ({amount})")
+    GAME["version"] += 1
+    ws_manager.schedule_broadcast()
+    return OK_RESPONSE
 
 @app.post("/cashier/reset_players")
-async def cashier_reset_players(req: Request):
-    try:
-        cashier_id = require_cashier(req)
-    except PermissionError as e:
-        return HTMLResponse(str(e), status_code=403)
-
-    to_remove = [uid for uid, p in GAME["players"].items() if p["role"] == "giocatore"]
-    for uid in to_remove:
-        GAME["players"].pop(uid, None)
-        GAME["ledger"].pop(uid, None)
-
-    GAME["prizes"] = []
-    GAME["pot"] = 0
+async def cashier_reset_players(cashier_id: str = Depends(require_cashier)):
+    # restano solo i cassieri: dizionari nuovi invece di un pop per ogni giocatore
+    ledger = GAME["ledger"]
+    cashiers = {uid: p for uid, p in GAME["players"].items() if p["role"] != "giocatore"}
+    GAME["players"] = cashiers
+    GAME["player_ids"] = set()
+    GAME["ledger"] = {uid: ledger[uid] for uid in cashiers if uid in ledger}
+
+    GAME["prizes"] = {}
+    GAME["prizes_unpaid"] = {}
+    GAME["prizes_paid"] = []
+    GAME["prizes_unpaid_total"] = 0
+    GAME["prizes_paid_total"] = 0
+    set_pot(0)
 
     if cashier_id in GAME["players"]:
         GAME["players"][cashier_id]["saldo"] = 0
-        GAME["ledger"][cashier_id] = []
+        GAME["ledger"][cashier_id] = deque(maxlen=LEDGER_MAX)
 
     add_log("Reset: giocatori invalidati, premi e montepremi azzerati, saldo cassiere azzerato.")
-    await ws_manager.broadcast()
-    return {"ok": True}
+    GAME["version"] += 1
+    ws_manager.schedule_broadcast()
+    return OK_RESPONSE
 
 @app.post("/cashier/logout")
-async def cashier_logout(req: Request):
-    try:
-        cashier_id = require_cashier(req)
-    except PermissionError as e:
-        return HTMLResponse(str(e), status_code=403)
-
+async def cashier_logout(cashier_id: str = Depends(require_cashier)):
     name = GAME["players"][cashier_id]["name"]
     GAME["players"].pop(cashier_id, None)
     GAME["ledger"].pop(cashier_id, None)
 
     # invalida anche il token di rientro: nessuno può rientrare finché non viene creato un nuovo cassiere
     GAME["cashier_rejoin_token"] = None
+    GAME["cashier_id"] = None
 
     add_log(f"Cassiere uscito: {name} (sessione invalidata)")
-    await ws_manager.broadcast()
-    return {"ok": True}
+    GAME["version"] += 1
+    ws_manager.schedule_broadcast()
+    return OK_RESPONSE
 
 # ==========================
 # START
 # ==========================
+# Lo stato è solo in memoria: serve un unico processo. Con più worker (anche via
+# WEB_CONCURRENCY con la CLI di uvicorn) ognuno avrebbe il proprio GAME e i propri client WS.
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", "9090"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        loop="auto",                 # uvloop se installato (non disponibile su Windows)
+        http="httptools",
+        ws="websockets",
+        log_level="warning",
+        access_log=False,
+    )
 